@@ -0,0 +1,214 @@
+#!python3
+
+from TracerSC import TracerSC, set_conversion_rules, set_point_selection
+import yaml
+import sys
+import time
+import math
+import json
+import logging
+import argparse
+import urllib3
+import requests
+from requests.adapters import BaseAdapter
+from os.path import exists
+
+# endpoint kinds, matched in order against the request url
+endpoint_kinds = [("/evox/about", "about"), ("/evox/config/", "config"), ("/installedSummary", "installed_summary"),
+                  ("/evox/equipment/spaces", "spaces")]
+
+
+def get_endpoint_kind(url):
+    for fragment, kind in endpoint_kinds:
+        if fragment in url:
+            return kind
+    if url.endswith("/attributes"):
+        return "attributes"
+    if url.endswith("/value"):
+        return "value"
+    return "other"
+
+
+class ReplayAdapter(BaseAdapter):
+    #serves responses recorded with --record instead of talking to the SC
+    def __init__(self, recording, delay=False):
+        super(ReplayAdapter, self).__init__()
+        self.recording = recording
+        self.delay = delay
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+
+        recorded = self.recording.get(request.url)
+        if recorded is None:
+            response.status_code = 404
+            response._content = b""
+            return response
+
+        if self.delay:
+            time.sleep(recorded["elapsed"])
+        response.status_code = recorded["status"]
+        response._content = recorded["content"].encode("utf-8")
+        #requests overwrites elapsed with the adapter time, so the recorded latency travels separately
+        response.recorded_elapsed = recorded["elapsed"]
+        return response
+
+    def close(self):
+        pass
+
+
+class LatencyRecorder(object):
+    def __init__(self, record=False):
+        self.latencies = {}
+        self.record = record
+        self.recording = {}
+
+    def on_response(self, response, *args, **kwargs):
+        elapsed = getattr(response, "recorded_elapsed", response.elapsed.total_seconds())
+        self.latencies.setdefault(get_endpoint_kind(response.url), []).append(elapsed)
+        if self.record and response.status_code == 200:
+            self.recording[response.url] = {"status": response.status_code, "elapsed": elapsed,
+                                            "content": response.content.decode("utf-8", "replace")}
+
+    def get_summary(self, kind):
+        samples = sorted(self.latencies.get(kind, []))
+        if len(samples) == 0:
+            return None
+        return {"count": len(samples), "mean": sum(samples) / len(samples),
+                "p95": samples[int(math.ceil(0.95 * len(samples))) - 1], "max": samples[-1]}
+
+
+def find_tracer(config, name):
+    for tracer in config["tracers"]:
+        if name is None or tracer["name"] == name or tracer["host"] == name:
+            return tracer
+    return None
+
+
+def print_report(sc, recorder, cycle_times, max_concurrency, headroom):
+    print("Capacity report for {} ({})".format(sc.get_name(), sc.get_hostname()))
+    print("")
+
+    families = {}
+    total_points = 0
+    for device in sc.get_devices():
+        family = families.setdefault(device.get_device_family(), [0, 0])
+        family[0] = family[0] + 1
+        family[1] = family[1] + len(device.get_points())
+        total_points = total_points + len(device.get_points())
+
+    print("{:<30} {:>8} {:>8}".format("Device family", "Devices", "Points"))
+    for family_name in sorted(families.keys()):
+        print("{:<30} {:>8} {:>8}".format(family_name, families[family_name][0], families[family_name][1]))
+    print("{:<30} {:>8} {:>8}".format("Total", len(sc.get_devices()), total_points))
+    print("")
+
+    print("{:<20} {:>8} {:>10} {:>10} {:>10}".format("Endpoint", "Requests", "Mean (s)", "p95 (s)", "Max (s)"))
+    for kind in sorted(recorder.latencies.keys()):
+        summary = recorder.get_summary(kind)
+        print("{:<20} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}".format(kind, summary["count"], summary["mean"], summary["p95"], summary["max"]))
+    print("")
+
+    if total_points == 0:
+        print("No points were discovered, so no cycle time can be measured.")
+        return
+
+    #measured rather than extrapolated, older firmware does not keep its latency under parallel load
+    print("{:<14} {:>20} {:>20}".format("Concurrency", "Mean cycle (s)", "Slowest cycle (s)"))
+    for level in sorted(cycle_times.keys()):
+        times = cycle_times[level]
+        print("{:<14} {:>20.2f} {:>20.2f}".format(level, sum(times) / len(times), max(times)))
+    print("")
+
+    cycle_time = max(cycle_times[max_concurrency])
+    print("Minimum poll_interval at concurrency {}: {}s (slowest measured cycle with {}x headroom)".format(
+        max_concurrency, int(math.ceil(cycle_time * headroom)), headroom))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the polling budget of a Tracer SC without connecting to MQTT.")
+    parser.add_argument("--config", default="config.yml", help="bridge configuration file (default config.yml)")
+    parser.add_argument("--sc", help="name or host of the tracer in the configuration (default the first one)")
+    parser.add_argument("--record", help="write the responses to this file for later --replay runs")
+    parser.add_argument("--replay", help="serve responses from a file written by --record instead of the SC")
+    parser.add_argument("--replay-delay", action="store_true", help="sleep for the recorded latency when replaying")
+    parser.add_argument("--passes", type=int, default=1, help="number of timed poll passes at each concurrency level (default 1)")
+    parser.add_argument("--concurrency", default="1,2,4,8,16", help="concurrency levels to measure (default 1,2,4,8,16)")
+    parser.add_argument("--headroom", type=float, default=1.2, help="headroom factor for the minimum poll_interval (default 1.2)")
+    args = parser.parse_args()
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+    logging.basicConfig(level=logging.WARNING)
+
+    if not exists(args.config):
+        print("Could not find the configuration file {}.".format(args.config))
+        return 1
+
+    with open(args.config, "r") as stream:
+        config = yaml.safe_load(stream)
+
+    tracer = find_tracer(config, args.sc)
+    if tracer is None:
+        print("No tracer named {} in {}.".format(args.sc, args.config))
+        return 1
+
+    bridge = config.get("bridge", {})
+    if "conversions" in bridge.keys():
+        set_conversion_rules(bridge["conversions"])
+    if "points" in config.keys():
+        set_point_selection(config["points"])
+
+    sc = TracerSC(tracer["name"], tracer["host"], tracer.get("username"), tracer.get("password"))
+    if "devices" in tracer.keys():
+        sc.set_fixed_discovery(tracer["devices"])
+    sc.set_request_timeout(float(tracer.get("timeout", 10)))
+
+    recorder = LatencyRecorder(args.record is not None)
+    sc.session.hooks["response"].append(recorder.on_response)
+    if args.replay is not None:
+        #mounted on the host prefix, so it outranks the adapter set_concurrency mounts on https://
+        with open(args.replay, "r") as stream:
+            sc.session.mount("https://{}/".format(tracer["host"]), ReplayAdapter(json.load(stream), args.replay_delay))
+
+    if not sc.discover_sc():
+        return 1
+    if bridge.get("discover_devices", False):
+        sc.discover_devices()
+    if bridge.get("discover_spaces", False):
+        sc.discover_spaces()
+
+    #metadata is read once up front so it does not run in the background during the timed passes
+    for device in sc.get_devices():
+        device.fetch_metadata()
+
+    #the configured maximum is always measured, the minimum poll_interval is based on it
+    max_concurrency = int(tracer.get("concurrency", {}).get("max", 4))
+    concurrency_levels = set(int(level) for level in args.concurrency.split(","))
+    concurrency_levels.add(max_concurrency)
+
+    #a fixed limit per level, so every pass runs with exactly that many requests in flight
+    cycle_times = {}
+    for level in sorted(concurrency_levels):
+        sc.set_concurrency(level, level)
+        cycle_times[level] = []
+        for poll_pass in range(max(1, args.passes)):
+            start_time = time.time()
+            sc.poll_devices()
+            cycle_times[level].append(time.time() - start_time)
+
+    print_report(sc, recorder, cycle_times, max_concurrency, args.headroom)
+
+    if args.record is not None:
+        with open(args.record, "w") as stream:
+            json.dump(recorder.recording, stream)
+        print("")
+        print("Recorded {} responses to {}.".format(len(recorder.recording), args.record))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,62 @@
 #!python3
 
-from TracerSC import TracerSC
+from TracerSC import TracerSC, build_conversion_rules, set_conversion_rules, create_point_selector, set_point_selector
+from TracerMQTTPublisher import MqttPublisher
+from TracerProfiling import Profiler, span, set_spans_enabled, log_span_stats
 from TracerMQTTObjects import get_trane_climate_sets, \
     discover_sensors, generate_mqtt_compatible_name, \
-    get_device_discovery_payload
+    get_device_discovery_payload, get_point_state_topic, \
+    get_device_state_topic, get_device_state_payload
 import yaml
 import time
 import paho.mqtt.client as MqttClient
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import logging
 import urllib3
 from os.path import exists
 import os
 import json
+import threading
+import re
+import signal
 
 # Global variables
 mqtt_client = None
+mqtt_publisher = None
+mqtt_qos = 0
 mqtt_base_topic = ""
 tracer_scs = []
+ha_discovery_enabled = True
+# "points" publishes one topic per point, "device" one JSON document per device, "both" does both
+state_mode = "points"
+metadata_cache = {}
+metadata_cache_file = "metadata_cache.json"
+metadata_cache_lock = threading.Lock()
+mqtt_protocol = MqttClient.MQTTv311
+mqtt_message_expiry = None
+mqtt_receive_maximum = 20
+mqtt_connack = threading.Event()
+mqtt_connack_rc = None
+unsupported_protocol_codes = [1, 132]
+topic_aliases = {}
+topic_alias_maximum = 0
+point_topics = {}
+config_file_name = "config.yml"
+running_config = None
+should_discover_devices = False
+should_discover_spaces = False
+poll_interval = 60
+watch_config = True
+config_watch_interval = 5
+reload_requested = False
+wake_event = threading.Event()
+profiler = Profiler()
+profile_request = None
+# last payload published per state topic, used to skip publishing unchanged state
+published_state = {}
+warm_start_collecting = False
+warm_state = {}
 
 should_exit = False
 
@@ -24,34 +64,285 @@ def on_received_mqtt_message(client, user_data, message):
     payload = str(message.payload.decode("utf-8"))
     topic = str(message.topic)
 
-def on_mqtt_connected(client, user_data, flags, rc):
-    logging.log(logging.INFO, "MQTT server is connected!")
+    if warm_start_collecting and message.retain:
+        warm_state[topic] = payload
+
+    #a retained command would replay on every (re)connect, so only live commands are acted on
+    if topic == "{}/bridge/profile".format(mqtt_base_topic) and not message.retain:
+        handle_profile_command(payload)
+
+def on_mqtt_connected(client, user_data, flags, rc, properties=None):
+    global mqtt_connack_rc, topic_aliases, topic_alias_maximum
+
+    mqtt_connack_rc = rc
+    if rc == 0:
+        logging.log(logging.INFO, "MQTT server is connected!")
+        client.subscribe("{}/bridge/profile".format(mqtt_base_topic))
+
+        #topic aliases only live as long as the connection
+        topic_aliases = {}
+        topic_alias_maximum = 0
+        if properties is not None:
+            if hasattr(properties, "TopicAliasMaximum"):
+                topic_alias_maximum = properties.TopicAliasMaximum
+            if hasattr(properties, "ReceiveMaximum"):
+                client.max_inflight_messages_set(min(properties.ReceiveMaximum, mqtt_receive_maximum))
+    else:
+        logging.log(logging.WARNING, "MQTT server refused the connection ({})!".format(rc))
+
+    mqtt_connack.set()
+
+def handle_profile_command(command):
+    global profile_request
+
+    command = command.strip().lower()
+    if command in ["start", "stop"]:
+        #the profiler has to be switched on the polling thread, so this is picked up between cycles
+        profile_request = command
+        wake_event.set()
+    elif command == "spans on":
+        set_spans_enabled(True)
+    elif command == "spans off":
+        set_spans_enabled(False)
+    else:
+        logging.log(logging.WARNING, "Unknown profile command {}.".format(command))
+
+def apply_profile_request():
+    global profile_request
+
+    if profile_request == "start":
+        profiler.start()
+    elif profile_request == "stop":
+        profiler.stop()
+    profile_request = None
+
+def toggle_profiler(signal_number=None, frame=None):
+    #signal handlers run on the main thread, which is the one polling and discovering
+    if profiler.is_running():
+        profiler.stop()
+    else:
+        profiler.start()
+
+def on_mqtt_published(client, user_data, mid):
+    if mqtt_publisher is not None:
+        mqtt_publisher.on_published(mid)
+
+def on_publish_lost(topic):
+    #forget what was never delivered, so the next poll sends it again instead of skipping it as unchanged
+    published_state.pop(topic, None)
+
+    #a device document is deduplicated through its point topics
+    state_prefix = "{}/state/".format(mqtt_base_topic)
+    if topic.startswith(state_prefix):
+        point_prefix = "{}/get/{}/".format(mqtt_base_topic, topic[len(state_prefix):])
+        for point_topic in list(published_state.keys()):
+            if point_topic.startswith(point_prefix):
+                published_state.pop(point_topic, None)
 
-def on_mqtt_disconnected(client, user_data, flags, rc):
+def on_mqtt_disconnected(client, user_data, rc, properties=None):
     logging.log(logging.CRITICAL, "MQTT server has disconnected!")
     should_exit = True
 
-def connect_mqtt(mqtt_server, mqtt_port, mqtt_client_id, mqtt_username=None, mqtt_password=None):
-    global mqtt_client
-
-    mqtt_client = MqttClient.Client(mqtt_client_id)
-    mqtt_client.on_message = on_received_mqtt_message
-    mqtt_client.on_connect = on_mqtt_connected
-    mqtt_client.on_disconnect = on_mqtt_disconnected
+def create_mqtt_client(mqtt_client_id, protocol, mqtt_username=None, mqtt_password=None):
+    if protocol == MqttClient.MQTTv5:
+        client = MqttClient.Client(mqtt_client_id, protocol=MqttClient.MQTTv5)
+    else:
+        client = MqttClient.Client(mqtt_client_id)
+    client.on_message = on_received_mqtt_message
+    client.on_connect = on_mqtt_connected
+    client.on_disconnect = on_mqtt_disconnected
+    client.on_publish = on_mqtt_published
 
     if mqtt_username is not None and mqtt_password is not None:
-        mqtt_client.username_pw_set(mqtt_username, mqtt_password)
+        client.username_pw_set(mqtt_username, mqtt_password)
+
+    return client
+
+def connect_mqtt(mqtt_server, mqtt_port, mqtt_client_id, mqtt_username=None, mqtt_password=None, protocol=MqttClient.MQTTv311):
+    global mqtt_client, mqtt_protocol, mqtt_connack_rc
+
+    mqtt_client = create_mqtt_client(mqtt_client_id, protocol, mqtt_username, mqtt_password)
+    mqtt_protocol = protocol
+    mqtt_connack.clear()
+    mqtt_connack_rc = None
 
     try:
-        mqtt_client.connect(mqtt_server, mqtt_port)
+        if protocol == MqttClient.MQTTv5:
+            connect_properties = Properties(PacketTypes.CONNECT)
+            connect_properties.ReceiveMaximum = mqtt_receive_maximum
+            mqtt_client.max_inflight_messages_set(mqtt_receive_maximum)
+            mqtt_client.connect(mqtt_server, mqtt_port, properties=connect_properties)
+        else:
+            mqtt_client.connect(mqtt_server, mqtt_port)
     except:
         return False
 
+    mqtt_client.loop_start()
+    mqtt_connack.wait(10)
+
     if mqtt_client.is_connected():
-        mqtt_client.loop_start()
         return True
-    else:
-        return False
+
+    #this client is given up on, so its disconnect is not the server going away
+    mqtt_client.on_disconnect = None
+    mqtt_client.disconnect()
+    mqtt_client.loop_stop()
+
+    #only an older broker is worth retrying on v3.1.1, refused credentials or authorization would be refused again
+    if protocol == MqttClient.MQTTv5 and is_unsupported_protocol(mqtt_connack_rc):
+        logging.log(logging.WARNING, "MQTT server did not accept an MQTT v5 connection, falling back to v3.1.1.")
+        return connect_mqtt(mqtt_server, mqtt_port, mqtt_client_id, mqtt_username, mqtt_password, MqttClient.MQTTv311)
+    return False
+
+def is_unsupported_protocol(rc):
+    #no CONNACK at all, a v3 "unacceptable protocol version" or the v5 "unsupported protocol version" reason code
+    if rc is None:
+        return True
+    return getattr(rc, "value", rc) in unsupported_protocol_codes
+
+def get_topic_alias(topic):
+    if topic in topic_aliases:
+        return topic_aliases[topic], True
+
+    if len(topic_aliases) < topic_alias_maximum:
+        topic_aliases[topic] = len(topic_aliases) + 1
+        return topic_aliases[topic], False
+
+    return None, False
+
+def send_message(topic, payload, qos=0, retain=False, alias=False):
+    global mqtt_client
+
+    if mqtt_protocol != MqttClient.MQTTv5:
+        return mqtt_client.publish(topic, payload, qos, retain)
+
+    properties = Properties(PacketTypes.PUBLISH)
+    if alias:
+        topic_alias, alias_established = get_topic_alias(topic)
+        if topic_alias is not None:
+            properties.TopicAlias = topic_alias
+            if alias_established and qos == 0:
+                #the broker already maps this alias, so the topic string can be left off the wire
+                #(QoS 1 keeps it, since paho resends those after a reconnect when the alias is gone)
+                topic = ""
+    if not retain and mqtt_message_expiry is not None:
+        properties.MessageExpiryInterval = mqtt_message_expiry
+
+    return mqtt_client.publish(topic, payload, qos, retain, properties=properties)
+
+def publish_state(topic, payload, retain=False, alias=False):
+    return mqtt_publisher.publish(topic, payload, mqtt_qos, retain, alias)
+
+def report_metrics():
+    metrics = mqtt_publisher.get_stats()
+
+    metrics["concurrency"] = {}
+    for sc in tracer_scs:
+        concurrency = sc.get_concurrency()
+        metrics["concurrency"][generate_mqtt_compatible_name(sc.get_name())] = {"limit": concurrency.get_limit(),
+                                                                               "p95": round(concurrency.get_last_p95(), 4)}
+        logging.log(logging.INFO, "Concurrency limit on {} is {} (p95 latency {:.3f}s).".format(sc.get_name(), concurrency.get_limit(),
+                                                                                                concurrency.get_last_p95()))
+
+    logging.log(logging.INFO, "Publish queue depth {}, {} in flight, {} published, {} coalesced, {} dropped, {} failed, "
+                              "latency avg {}s max {}s.".format(metrics["queue_depth"], metrics["inflight"], metrics["published"],
+                                                                metrics["coalesced"], metrics["dropped"], metrics["failed"],
+                                                                metrics["latency_avg"], metrics["latency_max"]))
+    publish_state("{}/bridge/metrics".format(mqtt_base_topic), json.dumps(metrics))
+
+def get_cached_point_topic(device, point):
+    if point not in point_topics:
+        point_topics[point] = get_point_state_topic(mqtt_base_topic, device, point.get_point_name())
+    return point_topics[point]
+
+def forget_tracer_state(sc):
+    #what a removed SC published says nothing about the broker by the time it is added again
+    for device in sc.get_devices():
+        for point in device.get_points():
+            point_topics.pop(point, None)
+
+    sc_name = generate_mqtt_compatible_name(sc.get_name())
+    prefixes = tuple("{}/{}/{}/".format(mqtt_base_topic, kind, sc_name) for kind in ["get", "state", "climate"])
+    for topic in list(published_state.keys()):
+        if topic.startswith(prefixes):
+            published_state.pop(topic, None)
+
+def load_metadata_cache(file_name):
+    global metadata_cache
+
+    if not exists(file_name):
+        return
+
+    try:
+        with open(file_name, "r") as stream:
+            metadata_cache = json.load(stream)
+    except:
+        logging.log(logging.WARNING, "Unable to read the device metadata cache {}, ignoring it.".format(file_name))
+        metadata_cache = {}
+
+def save_metadata_cache(file_name):
+    with metadata_cache_lock:
+        try:
+            with open(file_name, "w") as stream:
+                json.dump(metadata_cache, stream)
+        except:
+            logging.log(logging.WARNING, "Unable to write the device metadata cache {}!".format(file_name))
+
+def apply_cached_metadata(sc):
+    for device in sc.get_devices():
+        if device.get_id() in metadata_cache:
+            device.set_metadata(metadata_cache[device.get_id()])
+
+def on_device_metadata_loaded(device):
+    global mqtt_publisher, mqtt_base_topic
+
+    logging.log(logging.DEBUG, "Loaded metadata for device {}.".format(device.get_device_name()))
+    with metadata_cache_lock:
+        metadata_cache[device.get_id()] = device.get_metadata()
+    save_metadata_cache(metadata_cache_file)
+
+    if ha_discovery_enabled:
+        discover_sensors(mqtt_publisher, mqtt_base_topic, device, state_mode == "device")
+
+def collect_warm_state(timeout):
+    global warm_start_collecting
+
+    #read back our own retained state before discovery, so the first cycle only publishes real changes
+    topics = ["{}/get/#".format(mqtt_base_topic), "{}/state/#".format(mqtt_base_topic), "{}/climate/#".format(mqtt_base_topic)]
+    warm_start_collecting = True
+    for topic in topics:
+        mqtt_client.subscribe(topic)
+    time.sleep(timeout)
+    for topic in topics:
+        mqtt_client.unsubscribe(topic)
+    warm_start_collecting = False
+
+    logging.log(logging.INFO, "Warm start collected {} retained state messages.".format(len(warm_state)))
+
+def seed_warm_state(sc):
+    for device in sc.get_devices():
+        device_state = {}
+        device_topic = get_device_state_topic(mqtt_base_topic, device)
+        if device_topic in warm_state:
+            try:
+                device_state = json.loads(warm_state[device_topic])
+            except ValueError:
+                device_state = {}
+
+        for point in device.get_points():
+            topic = get_cached_point_topic(device, point)
+            key = generate_mqtt_compatible_name(point.get_point_name())
+            if topic in warm_state:
+                point.seed_value(warm_state[topic])
+            elif isinstance(device_state.get(key), dict) and "value" in device_state[key]:
+                point.seed_value(str(device_state[key].get("value")), device_state[key].get("type"))
+            else:
+                continue
+            published_state[topic] = point.get_point_value()
+
+    for topic, payload in warm_state.items():
+        if topic.startswith("{}/climate/".format(mqtt_base_topic)):
+            published_state[topic] = payload
 
 def poll(last_time, retain=False):
     global mqtt_client, tracer_scs
@@ -62,27 +353,56 @@ def poll(last_time, retain=False):
         logging.log(logging.INFO, "Polling finished on {}, now exporting to MQTT.".format(sc.get_name()))
 
         for device in sc.get_devices():
+            changed_points = []
             for point in device.get_points():
                 if point.get_point_last_updated() > last_time:
-                    mqtt_client.publish("{}/get/{}/{}/{}".format(mqtt_base_topic,
-                                                             generate_mqtt_compatible_name(sc.get_name()),
-                                                             generate_mqtt_compatible_name(device.get_device_name()),
-                                                             generate_mqtt_compatible_name(point.get_point_name())),
-                                        point.get_point_value(), retain=retain)
+                    #retained values persist on the broker, so unchanged values do not need to be sent again
+                    topic = get_cached_point_topic(device, point)
+                    value = point.get_point_value()
+                    if retain and published_state.get(topic) == value:
+                        continue
+                    published_state[topic] = value
+                    changed_points.append(point)
+
+            with span("publish", sc.get_name(), device.get_device_name()):
+                if state_mode != "device":
+                    for point in changed_points:
+                        publish_state(get_cached_point_topic(device, point), point.get_point_value(), retain, True)
+
+                #the device document replaces the retained one, so it always carries every known point
+                if state_mode != "points" and len(changed_points) > 0:
+                    known_points = [point for point in device.get_points() if point.get_point_type() != ""]
+                    publish_state(get_device_state_topic(mqtt_base_topic, device),
+                                  get_device_state_payload(known_points), retain, True)
+
+def publish_climate_sets(ha_discovery=True, retain=False):
+    for sc in tracer_scs:
+        for device in sc.get_devices():
+            for set in get_trane_climate_sets(device):
+                try:
+                    publish_climate_set(set, ha_discovery, retain)
+                except (ValueError, TypeError, AttributeError):
+                    logging.log(logging.WARNING, "Unable to evaluate climate state of {}, some values are missing.".format(device.get_device_name()))
 
-def publish_climate_set(climate_set, discovery=True):
-    global mqtt_client, mqtt_base_topic
+def publish_climate_set(climate_set, discovery=True, retain=False):
+    global mqtt_publisher, mqtt_base_topic
 
     sc_name = generate_mqtt_compatible_name(climate_set.get_device().get_sc().get_name())
     device_name = generate_mqtt_compatible_name(climate_set.get_device().get_device_name())
     topic = "{}/climate/{}/{}".format(mqtt_base_topic, sc_name, device_name)
+    #a state built only from seeded values is already what the broker holds, so wait for the first poll
+    if climate_set.is_stale():
+        return
+
+    with span("climate", climate_set.get_device().get_sc().get_name(), climate_set.get_device().get_device_name()):
+        state = climate_set.evaluate()
 
     if discovery:
         discovery = {"dev": get_device_discovery_payload(climate_set.get_device()),
                      "act_t": topic, "curr_temp_t": topic, "act_tpl": "{{value_json.action}}",
                      "curr_temp_tpl": "{{value_json.temp}}",
                      "fan_mode_stat_t": topic, "fan_mode_stat_tpl": "{{value_json.fan}}",
-                     "fan_modes": ["off", "on"], "init": climate_set.get_temp_setpoint(),
+                     "fan_modes": ["off", "on"], "init": state["set"],
                      "mode_stat_t": topic, "mode_stat_tpl": "{{value_json.mode}}",
                      "modes": ["off", "heat", "cool"], "name": "{} ({})".format(climate_set.get_device().get_device_name(), climate_set.get_device().get_sc().get_name()),
                      "precision": 0.1, "temp_stat_t": topic, "temp_stat_tpl": "{{value_json.set}}",
@@ -92,19 +412,275 @@ def publish_climate_set(climate_set, discovery=True):
                      "temp_cmd_t": "tracer2mqtt/ignored"}
         discovery = json.dumps(discovery)
 
-        mqtt_client.publish("homeassistant/climate/{}/{}_{}/config".format(sc_name, sc_name, device_name), discovery,
-                            retain=True)
+        mqtt_publisher.publish("homeassistant/climate/{}/{}_{}/config".format(sc_name, sc_name, device_name), discovery,
+                               retain=True)
 
         time.sleep(0.5)
 
-    payload = {"action": climate_set.get_climate_run_mode(), "temp": climate_set.get_temp_active(), "fan": climate_set.get_fan_state(),
-               "mode": climate_set.get_climate_set_mode(), "set": climate_set.get_temp_setpoint()}
-    payload = json.dumps(payload)
+    #a retained state stays on the broker for late subscribers, otherwise it is sent every cycle
+    payload = climate_set.get_state_payload(state)
+    if retain and published_state.get(topic) == payload:
+        return
+
+    publish_state(topic, payload, retain, True)
+    published_state[topic] = payload
+
+def read_config(file_name):
+    with open(file_name, "r") as stream:
+        try:
+            config = yaml.safe_load(stream)
+        except yaml.YAMLError as yaml_error:
+            logging.log(logging.CRITICAL, "The configuration file is not valid YAML syntax.  Please check the file and restart.")
+            return None
+
+    if not isinstance(config, dict) or "tracers" not in config.keys() or "bridge" not in config.keys() or "mqtt" not in config.keys():
+        logging.log(logging.CRITICAL, "At least one configuration section is missing.  Required: tracers, bridge, mqtt.")
+        return None
 
-    mqtt_client.publish(topic, payload)
+    if not isinstance(config["bridge"], dict) or not isinstance(config["mqtt"], dict):
+        logging.log(logging.CRITICAL, "The bridge and mqtt configuration sections must be mappings.")
+        return None
+
+    if not isinstance(config["tracers"], list) or len(config["tracers"]) == 0:
+        logging.log(logging.CRITICAL, "The tracers configuration section must be a list with at least one Tracer.")
+        return None
+
+    for tracer in config["tracers"]:
+        if not isinstance(tracer, dict) or "host" not in tracer.keys() or "name" not in tracer.keys():
+            logging.log(logging.CRITICAL, "A Tracer entry in the configuration is missing a hostname or display name.")
+            return None
+
+        if not isinstance(tracer.get("devices", []), list):
+            logging.log(logging.CRITICAL, "The devices of Tracer {} must be a list of device names.".format(tracer["name"]))
+            return None
+
+        try:
+            parse_concurrency(tracer)
+            parse_timeout(tracer)
+        except (ValueError, TypeError, AttributeError) as concurrency_error:
+            logging.log(logging.CRITICAL, "Invalid concurrency configuration on Tracer {}: {}".format(tracer["name"], concurrency_error))
+            return None
+
+    return config
+
+def create_tracer(tracer):
+    if "username" in tracer.keys():
+        tracer_username = tracer["username"]
+    else:
+        tracer_username = None
+
+    if "password" in tracer.keys():
+        tracer_password = tracer["password"]
+    else:
+        tracer_password = None
+
+    tracer_obj = TracerSC(tracer["name"], tracer["host"], tracer_username, tracer_password)
+    if "devices" in tracer.keys():
+        tracer_obj.set_fixed_discovery(tracer["devices"])
+    apply_concurrency(tracer_obj, tracer)
+    tracer_obj.set_request_timeout(parse_timeout(tracer))
+    return tracer_obj
+
+def parse_concurrency(tracer):
+    concurrency = tracer.get("concurrency", {})
+    if concurrency is None:
+        concurrency = {}
+    return int(concurrency.get("min", 1)), int(concurrency.get("max", 4)), float(concurrency.get("target_latency", 0.5))
+
+def parse_timeout(tracer):
+    timeout = float(tracer.get("timeout", 10))
+    if timeout <= 0:
+        raise ValueError("The request timeout must be more than 0 seconds.")
+    return timeout
+
+def apply_concurrency(sc, tracer):
+    minimum, maximum, target_latency = parse_concurrency(tracer)
+    sc.set_concurrency(minimum, maximum, target_latency)
+
+def parse_bridge_settings(config):
+    #reads every setting into a dict first, so a bad value leaves the running settings untouched
+    bridge = config["bridge"]
+    settings = {"discover_devices": bridge.get("discover_devices", False), "discover_spaces": bridge.get("discover_spaces", False),
+                "ha_discovery": bridge.get("ha_discovery", True), "metadata_cache": bridge.get("metadata_cache"),
+                "watch_config": bridge.get("watch_config"), "profile_dir": bridge.get("profile_dir"),
+                "profile_spans": bridge.get("profile_spans"), "log_level": bridge.get("log_level")}
+
+    #both tables are rebuilt from the defaults, so a removed section also removes its rules
+    try:
+        #an empty section in the YAML reads as None
+        settings["conversions"] = bridge.get("conversions") or {}
+        build_conversion_rules(settings["conversions"])
+    except (ValueError, AttributeError) as conversion_error:
+        raise ValueError("Invalid value conversion configuration: {}".format(conversion_error))
+
+    try:
+        settings["point_selector"] = create_point_selector(config.get("points") or {})
+    except (ValueError, AttributeError, re.error) as selection_error:
+        raise ValueError("Invalid point selection configuration: {}".format(selection_error))
+
+    settings["poll_interval"] = int(bridge.get("poll_interval", 60))
+    if settings["poll_interval"] < 1:
+        raise ValueError("The poll_interval must be at least 1 second.")
+
+    #non-retained state expires once it is older than two poll cycles, unless configured otherwise
+    settings["message_expiry"] = int(config["mqtt"].get("message_expiry", settings["poll_interval"] * 2))
+    return settings
+
+def load_bridge_settings(config):
+    global ha_discovery_enabled, metadata_cache_file, should_discover_devices, should_discover_spaces, poll_interval, \
+        mqtt_message_expiry, watch_config
+
+    try:
+        settings = parse_bridge_settings(config)
+    except (ValueError, TypeError) as settings_error:
+        logging.log(logging.CRITICAL, "Invalid bridge configuration: {}".format(settings_error))
+        return False
+
+    should_discover_devices = settings["discover_devices"]
+    should_discover_spaces = settings["discover_spaces"]
+    ha_discovery_enabled = settings["ha_discovery"]
+
+    if settings["metadata_cache"] is not None:
+        metadata_cache_file = settings["metadata_cache"]
+
+    if settings["watch_config"] is not None:
+        watch_config = settings["watch_config"]
+
+    if settings["profile_dir"] is not None:
+        profiler.output_dir = settings["profile_dir"]
+
+    if settings["profile_spans"] is not None:
+        set_spans_enabled(settings["profile_spans"])
+
+    log_level_string = settings["log_level"]
+    if log_level_string == "DEBUG":
+        logging.basicConfig(level=logging.DEBUG)
+    elif log_level_string == "WARNING":
+        logging.basicConfig(level=logging.WARNING)
+    elif log_level_string == "CRITICAL":
+        logging.basicConfig(level=logging.CRITICAL)
+
+    set_conversion_rules(settings["conversions"])
+    set_point_selector(settings["point_selector"])
+    poll_interval = settings["poll_interval"]
+    mqtt_message_expiry = settings["message_expiry"]
+
+    return True
+
+def discover_tracer(sc):
+    sc.set_metadata_listener(on_device_metadata_loaded)
+    if not sc.is_reachable():
+        sc.discover_sc()
+    if should_discover_devices:
+        sc.discover_devices()
+    if should_discover_spaces:
+        sc.discover_spaces()
+    apply_cached_metadata(sc)
+
+def announce_devices(devices):
+    #devices still waiting on metadata are announced with the defaults, and again once their metadata arrives
+    if ha_discovery_enabled:
+        for device in devices:
+            discover_sensors(mqtt_publisher, mqtt_base_topic, device, state_mode == "device")
+
+def reload_config():
+    global running_config, tracer_scs
+
+    logging.log(logging.INFO, "Reloading configuration from {}.".format(config_file_name))
+    config = read_config(config_file_name)
+    if config is None:
+        logging.log(logging.WARNING, "Keeping the running configuration, the new configuration is not valid.")
+        return False
+
+    if config["mqtt"] != running_config["mqtt"]:
+        logging.log(logging.WARNING, "MQTT configuration changes are only applied after a restart.")
+
+    if not load_bridge_settings(config):
+        logging.log(logging.WARNING, "Keeping the running configuration, the new configuration is not valid.")
+        return False
+
+    #conversion rules may have changed, so recompile them on the points we already know about
+    for sc in tracer_scs:
+        for device in sc.get_devices():
+            for point in device.get_points():
+                point.compile_conversion()
+
+    points_changed = config.get("points") != running_config.get("points")
+
+    running_tracers = {}
+    for sc in tracer_scs:
+        running_tracers[sc.get_hostname()] = sc
+
+    new_tracer_scs = []
+    for tracer in config["tracers"]:
+        sc = running_tracers.pop(tracer["host"], None)
+        old_tracer = None
+        if sc is not None:
+            for running_tracer in running_config["tracers"]:
+                if running_tracer["host"] == tracer["host"]:
+                    old_tracer = running_tracer
+
+        changed_identity = old_tracer is None or old_tracer["name"] != tracer["name"] or \
+            old_tracer.get("username") != tracer.get("username") or old_tracer.get("password") != tracer.get("password")
+
+        if sc is None or changed_identity:
+            if sc is not None:
+                sc.shutdown()
+                forget_tracer_state(sc)
+            logging.log(logging.INFO, "Adding SC {} ({}).".format(tracer["name"], tracer["host"]))
+            sc = create_tracer(tracer)
+            discover_tracer(sc)
+            announce_devices(sc.get_devices())
+        elif old_tracer.get("devices", []) != tracer.get("devices", []):
+            logging.log(logging.INFO, "Refiltering devices on SC {} ({}).".format(sc.get_name(), sc.get_hostname()))
+            known_devices = list(sc.get_devices())
+            sc.set_fixed_discovery(tracer.get("devices", []))
+            sc.refilter_devices()
+            discover_tracer(sc)
+            announce_devices([device for device in sc.get_devices() if device not in known_devices])
+
+        if not changed_identity and points_changed:
+            logging.log(logging.INFO, "Rediscovering points on SC {} ({}).".format(sc.get_name(), sc.get_hostname()))
+            sc.rediscover_points()
+            announce_devices(sc.get_devices())
+
+        if not changed_identity and old_tracer.get("concurrency") != tracer.get("concurrency"):
+            apply_concurrency(sc, tracer)
+        sc.set_request_timeout(parse_timeout(tracer))
+
+        new_tracer_scs.append(sc)
+
+    for sc in running_tracers.values():
+        logging.log(logging.INFO, "Removing SC {} ({}).".format(sc.get_name(), sc.get_hostname()))
+        sc.shutdown()
+        forget_tracer_state(sc)
+
+    tracer_scs = new_tracer_scs
+    point_topics.clear()
+    running_config = config
+    return True
+
+def request_reload(signal_number=None, frame=None):
+    global reload_requested
+
+    reload_requested = True
+    wake_event.set()
+
+def watch_config_file():
+    last_modified = os.path.getmtime(config_file_name)
+    while should_exit is False:
+        time.sleep(config_watch_interval)
+        try:
+            modified = os.path.getmtime(config_file_name)
+        except OSError:
+            continue
+        if watch_config and modified != last_modified:
+            last_modified = modified
+            request_reload()
 
 def main():
-    global tracer_scs, mqtt_base_topic, mqtt_client
+    global tracer_scs, mqtt_base_topic, mqtt_client, state_mode, mqtt_receive_maximum, config_file_name, \
+        running_config, reload_requested, mqtt_publisher, mqtt_qos
 
     #set reasonable logging defaults
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -113,8 +689,6 @@ def main():
     logging.basicConfig(level=logging.INFO)
 
     #read configuration
-    config = None
-
     if exists("config.yml"):
         config_file_name = "config.yml"
     elif exists("config.yaml"):
@@ -124,40 +698,15 @@ def main():
         os.exit(1)
         return
 
-    with open(config_file_name, "r") as stream:
-        try:
-            config = yaml.safe_load(stream)
-        except yaml.YAMLError as yaml_error:
-            logging.log(logging.CRITICAL, "The configuration file is not valid YAML syntax.  Please check the file and restart.")
-            os.exit(1)
-            return
-
-    if "tracers" not in config.keys() or "bridge" not in config.keys() or "mqtt" not in config.keys():
-        logging.log(logging.CRITICAL, "At least one configuration section is missing.  Required: tracers, bridge, mqtt.")
+    config = read_config(config_file_name)
+    if config is None:
         os.exit(1)
         return
+    running_config = config
 
     #load tracers
     for tracer in config["tracers"]:
-        if "host" not in tracer.keys() or "name" not in tracer.keys():
-            logging.log(logging.CRITICAL, "A Tracer entry in the configuration is missing a hostname or display name.")
-            os.exit(1)
-            return
-
-        if "username" in tracer.keys():
-            tracer_username = tracer["username"]
-        else:
-            tracer_username = None
-
-        if "password" in tracer.keys():
-            tracer_password = tracer["password"]
-        else:
-            tracer_password = None
-
-        tracer_obj = TracerSC(tracer["name"], tracer["host"], tracer_username, tracer_password)
-        if "devices" in tracer.keys():
-            tracer_obj.set_fixed_discovery(tracer["devices"])
-        tracer_scs.append(tracer_obj)
+        tracer_scs.append(create_tracer(tracer))
 
     #load mqtt
     if "server" not in config["mqtt"].keys() or "port" not in config["mqtt"].keys() or "client_id" not in config["mqtt"].keys():
@@ -180,66 +729,104 @@ def main():
     else:
         retain_values = False
 
-    mqtt_base_topic = config["mqtt"]["base_topic"]
-    connect_mqtt(config["mqtt"]["server"], config["mqtt"]["port"], config["mqtt"]["client_id"], mqtt_username, mqtt_password)
+    if "state_mode" in config["mqtt"].keys():
+        state_mode = config["mqtt"]["state_mode"]
+        if state_mode not in ["points", "device", "both"]:
+            logging.log(logging.CRITICAL, "MQTT state_mode must be one of points, device or both.")
+            os.exit(1)
+            return
 
-    if "discover_devices" not in config["bridge"].keys():
-        should_discover_devices = False
-    else:
-        should_discover_devices = config["bridge"]["discover_devices"]
+    protocol = MqttClient.MQTTv311
+    if "protocol" in config["mqtt"].keys() and str(config["mqtt"]["protocol"]).lower() in ["5", "v5", "5.0"]:
+        protocol = MqttClient.MQTTv5
 
-    if "discover_spaces" not in config["bridge"].keys():
-        should_discover_spaces = False
-    else:
-        should_discover_spaces = config["bridge"]["discover_spaces"]
+    if "receive_maximum" in config["mqtt"].keys():
+        mqtt_receive_maximum = int(config["mqtt"]["receive_maximum"])
 
-    if "ha_discovery" not in config["bridge"].keys():
-        ha_discovery = True
-    else:
-        ha_discovery = config["bridge"]["ha_discovery"]
+    if "qos" in config["mqtt"].keys():
+        mqtt_qos = int(config["mqtt"]["qos"])
+
+    #state is handed to a publish stage with a bounded queue, so polling and publishing run independently
+    try:
+        mqtt_publisher = MqttPublisher(send_message, int(config["mqtt"].get("queue_size", 1000)),
+                                       config["mqtt"].get("queue_policy", "block"), int(config["mqtt"].get("max_inflight", 20)),
+                                       on_lost=on_publish_lost)
+    except ValueError as publisher_error:
+        logging.log(logging.CRITICAL, "Invalid MQTT queue configuration: {}".format(publisher_error))
+        os.exit(1)
+        return
+    mqtt_publisher.start()
 
-    if "log_level" in config["bridge"].keys():
-        log_level_string = config["bridge"]["log_level"]
-        if log_level_string == "DEBUG":
-            logging.basicConfig(level=logging.DEBUG)
-        elif log_level_string == "WARNING":
-            logging.basicConfig(level=logging.WARNING)
-        elif log_level_string == "CRITICAL":
-            logging.basicConfig(level=logging.CRITICAL)
+    mqtt_base_topic = config["mqtt"]["base_topic"]
+    connect_mqtt(config["mqtt"]["server"], config["mqtt"]["port"], config["mqtt"]["client_id"], mqtt_username, mqtt_password, protocol)
 
-    poll_interval = 60
-    if "poll_interval" in config["bridge"].keys():
-        poll_interval = int(config["bridge"]["poll_interval"])
+    if not load_bridge_settings(config):
+        os.exit(1)
+        return
+    load_metadata_cache(metadata_cache_file)
+
+    #reload the configuration on SIGHUP or when the file changes, Windows has no SIGHUP and relies on the file watcher
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, request_reload)
+    #SIGUSR1 starts and stops the profiler, results are written to bridge.profile_dir (elsewhere use the profile command)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, toggle_profiler)
+    threading.Thread(target=watch_config_file, daemon=True).start()
+
+    warm_start = retain_values
+    if "warm_start" in config["bridge"].keys():
+        warm_start = config["bridge"]["warm_start"]
+    if warm_start:
+        warm_start_timeout = 3
+        if "warm_start_timeout" in config["bridge"].keys():
+            warm_start_timeout = float(config["bridge"]["warm_start_timeout"])
+        collect_warm_state(warm_start_timeout)
 
     #Discover points on the SCs
     for sc in tracer_scs:
-        sc.discover_sc()
-        if should_discover_devices:
-            sc.discover_devices()
-        if should_discover_spaces:
-            sc.discover_spaces()
+        discover_tracer(sc)
+        seed_warm_state(sc)
+
+    #the snapshot is only current at startup, SCs added by a reload start from a fresh poll
+    warm_state.clear()
 
     #Start polling
     last_poll = 0
     while should_exit is False:
+        apply_profile_request()
         poll(last_poll, retain_values)
 
         #discover some compatible sensors
-        if ha_discovery and last_poll == 0:
+        if last_poll == 0:
             for sc in tracer_scs:
-                for device in sc.get_devices():
-                    discover_sensors(mqtt_client, mqtt_base_topic, device)
+                announce_devices(sc.get_devices())
 
         #convert to objects when possible
-        for sc in tracer_scs:
-            for device in sc.get_devices():
-                for set in get_trane_climate_sets(device):
-                    publish_climate_set(set, ha_discovery)
+        publish_climate_sets(ha_discovery_enabled, retain_values)
+        report_metrics()
+        log_span_stats()
 
         last_poll = time.time()
-        time.sleep(poll_interval)
+
+        #wait for the next cycle, applying configuration reloads as they are requested
+        while should_exit is False:
+            remaining = last_poll + poll_interval - time.time()
+            if remaining <= 0:
+                break
+            wake_event.wait(remaining)
+            wake_event.clear()
+            if reload_requested:
+                reload_requested = False
+                try:
+                    reload_config()
+                except Exception as reload_error:
+                    logging.log(logging.WARNING, "Keeping the running configuration, the reload failed: {}".format(reload_error))
+            if profile_request is not None:
+                apply_profile_request()
 
     #Once we are ready to exit, stop MQTT
+    profiler.stop()
+    mqtt_publisher.stop()
     mqtt_client.disconnect()
     mqtt_client.loop_stop()
     os.exit(0)
@@ -4,107 +4,139 @@ import logging
 import json
 
 
-def discover_sensors(mqtt_client, mqtt_base_topic, device):
+def discover_sensors(mqtt_client, mqtt_base_topic, device, json_state=False):
     sc = device.get_sc()
 
     logging.log(logging.INFO, "Discovering Communication Status sensors on {} ({})...".format(device.get_device_name(),
                                                                                               sc.get_name()))
-    publish_device_communication_status(mqtt_client, mqtt_base_topic, device)
+    publish_device_communication_status(mqtt_client, mqtt_base_topic, device, json_state)
     logging.log(logging.INFO,
                 "Discovering Occupancy Status sensors on {} ({})...".format(device.get_device_name(), sc.get_name()))
-    publish_device_occupancy_status(mqtt_client, mqtt_base_topic, device)
+    publish_device_occupancy_status(mqtt_client, mqtt_base_topic, device, json_state)
     logging.log(logging.INFO,
                 "Discovering Discharge Temp sensors on {} ({})...".format(device.get_device_name(), sc.get_name()))
-    publish_discharge_temp_sensors(mqtt_client, mqtt_base_topic, device)
+    publish_discharge_temp_sensors(mqtt_client, mqtt_base_topic, device, json_state)
     logging.log(logging.INFO,
                 "Discovering Space Temp sensors on {} ({})...".format(device.get_device_name(), sc.get_name()))
-    publish_space_temp_sensors(mqtt_client, mqtt_base_topic, device)
+    publish_space_temp_sensors(mqtt_client, mqtt_base_topic, device, json_state)
     logging.log(logging.INFO,
                 "Discovering Space Humidity sensors on {} ({})...".format(device.get_device_name(), sc.get_name()))
-    publish_space_humidity_sensors(mqtt_client, mqtt_base_topic, device)
+    publish_space_humidity_sensors(mqtt_client, mqtt_base_topic, device, json_state)
     logging.log(logging.INFO,
                 "Discovering Outdoor Temp sensors on {} ({})...".format(device.get_device_name(), sc.get_name()))
-    publish_outdoor_temp_sensors(mqtt_client, mqtt_base_topic, device)
+    publish_outdoor_temp_sensors(mqtt_client, mqtt_base_topic, device, json_state)
     logging.log(logging.INFO,
                 "Discovering Outdoor Humidity sensors on {} ({})...".format(device.get_device_name(), sc.get_name()))
-    publish_outdoor_humidity_sensors(mqtt_client, mqtt_base_topic, device)
+    publish_outdoor_humidity_sensors(mqtt_client, mqtt_base_topic, device, json_state)
 
-def publish_device_communication_status(mqtt_client, mqtt_base_topic, device):
+def publish_device_communication_status(mqtt_client, mqtt_base_topic, device, json_state=False):
     if device.get_point("CommunicationStatus") is not None:
         sc = device.get_sc()
         sc_name = generate_mqtt_compatible_name(sc.get_name())
         device_name = generate_mqtt_compatible_name(device.get_device_name())
-        topic = "{}/get/{}/{}/communicationstatus".format(mqtt_base_topic, sc_name, device_name)
 
         discovery = {"dev": get_sc_discovery_payload(sc), "dev_cla": "connectivity", "entity_category": "diagnostic",
                      "name": "{} Comm Status".format(device.get_device_name()), "uniq_id": "{}_{}_comm".format(sc_name, device_name),
-                     "stat_t": topic, "pl_on": "True", "pl_off": "False"}
+                     "pl_on": "True", "pl_off": "False"}
+        discovery.update(get_point_state_discovery(mqtt_base_topic, device, "CommunicationStatus", json_state, True))
         discovery = json.dumps(discovery)
         mqtt_client.publish("homeassistant/binary_sensor/{}/{}_{}_comm/config".format(sc_name, sc_name, device_name), discovery,
                             retain=True)
 
-def publish_device_occupancy_status(mqtt_client, mqtt_base_topic, device):
+def publish_device_occupancy_status(mqtt_client, mqtt_base_topic, device, json_state=False):
     if device.get_point("OccupancyStatus") is not None:
         sc = device.get_sc()
         sc_name = generate_mqtt_compatible_name(sc.get_name())
         device_name = generate_mqtt_compatible_name(device.get_device_name())
-        topic = "{}/get/{}/{}/occupancystatus".format(mqtt_base_topic, sc_name, device_name)
 
         discovery = {"dev": get_device_discovery_payload(device), "dev_cla": "occupancy",
                      "name": "{} Occupancy".format(device.get_device_name()), "uniq_id": "{}_{}_occ".format(sc_name, device_name),
-                     "stat_t": topic, "pl_on": "True", "pl_off": "False"}
+                     "pl_on": "True", "pl_off": "False"}
+        discovery.update(get_point_state_discovery(mqtt_base_topic, device, "OccupancyStatus", json_state, True))
         discovery = json.dumps(discovery)
         mqtt_client.publish("homeassistant/binary_sensor/{}/{}_{}_occ/config".format(sc_name, sc_name, device_name), discovery,
                             retain=True)
 
-def publish_discharge_temp_sensors(mqtt_client, mqtt_base_topic, device):
+def publish_discharge_temp_sensors(mqtt_client, mqtt_base_topic, device, json_state=False):
     discharge_temps = ["DischargeAirTemp"]
     publish_one_of_points_sensor(mqtt_client, mqtt_base_topic, device, discharge_temps, "Discharge Air Temperature", "discharge_temp",
-                             "temperature", "°F")
+                             "temperature", "°F", json_state)
 
-def publish_space_temp_sensors(mqtt_client, mqtt_base_topic, device):
+def publish_space_temp_sensors(mqtt_client, mqtt_base_topic, device, json_state=False):
     space_temps = ["SpaceTempActive"]
     publish_one_of_points_sensor(mqtt_client, mqtt_base_topic, device, space_temps, "Space Temperature", "space_temp",
-                                 "temperature", "°F")
+                                 "temperature", "°F", json_state)
 
-def publish_space_humidity_sensors(mqtt_client, mqtt_base_topic, device):
+def publish_space_humidity_sensors(mqtt_client, mqtt_base_topic, device, json_state=False):
     space_humidity = ["SpaceRelHumidityActive", "SpaceRelHumidityLocal"]
     publish_one_of_points_sensor(mqtt_client, mqtt_base_topic, device, space_humidity, "Space Humidity",
-                                 "space_humidity", "humidity", "%")
+                                 "space_humidity", "humidity", "%", json_state)
 
-def publish_outdoor_temp_sensors(mqtt_client, mqtt_base_topic, device):
+def publish_outdoor_temp_sensors(mqtt_client, mqtt_base_topic, device, json_state=False):
     outdoor_temps = ["OutdoorAirTempActive", "OutdoorAirTempBAS", "OutdoorAirTempLocal"]
     publish_one_of_points_sensor(mqtt_client, mqtt_base_topic, device, outdoor_temps, "Outdoor Temperature", "outdoor_temp",
-                                 "temperature", "°F")
+                                 "temperature", "°F", json_state)
 
-def publish_outdoor_humidity_sensors(mqtt_client, mqtt_base_topic, device):
+def publish_outdoor_humidity_sensors(mqtt_client, mqtt_base_topic, device, json_state=False):
     outdoor_humidity = ["OutdoorAirRelHumidityActive", "OutdoorAirRHActive", "OutdoorAirRelHumidityBAS", "OutdoorAirRelHumidityLocal"]
     publish_one_of_points_sensor(mqtt_client, mqtt_base_topic, device, outdoor_humidity, "Outdoor Humidity",
-                                 "outdoor_humidity", "humidity", "%")
+                                 "outdoor_humidity", "humidity", "%", json_state)
 
-def publish_one_of_points_sensor(mqtt_client, mqtt_base_topic, device, points, name, short_name, dev_class, unit):
+def publish_one_of_points_sensor(mqtt_client, mqtt_base_topic, device, points, name, short_name, dev_class, unit, json_state=False):
     for point in points:
         if device.get_point(point) is not None:
-            publish_value_sensor(mqtt_client, mqtt_base_topic, device, point, name, short_name, dev_class, unit)
+            publish_value_sensor(mqtt_client, mqtt_base_topic, device, point, name, short_name, dev_class, unit, json_state)
             return True
     return False
 
-def publish_value_sensor(mqtt_client, mqtt_base_topic, device, point, name, short_name, dev_class, unit):
+def publish_value_sensor(mqtt_client, mqtt_base_topic, device, point, name, short_name, dev_class, unit, json_state=False):
     if device.get_point(point) is not None:
         sc = device.get_sc()
         sc_name = generate_mqtt_compatible_name(sc.get_name())
         device_name = generate_mqtt_compatible_name(device.get_device_name())
-        topic = "{}/get/{}/{}/{}".format(mqtt_base_topic, sc_name, device_name, generate_mqtt_compatible_name(point))
 
         discovery = {"dev": get_device_discovery_payload(device), "dev_cla": dev_class,
                      "name": "{} {}".format(device.get_device_name(), name),
                      "uniq_id": "{}_{}_{}".format(sc_name, device_name, short_name),
-                     "stat_t": topic, "state_class": "measurement", "unit_of_measurement": unit}
+                     "state_class": "measurement", "unit_of_measurement": unit}
+        discovery.update(get_point_state_discovery(mqtt_base_topic, device, point, json_state))
         discovery = json.dumps(discovery)
         mqtt_client.publish("homeassistant/sensor/{}/{}_{}_{}/config".format(sc_name, sc_name, device_name, short_name),
                             discovery,
                             retain=True)
 
+def get_point_state_topic(mqtt_base_topic, device, point):
+    return "{}/get/{}/{}/{}".format(mqtt_base_topic, generate_mqtt_compatible_name(device.get_sc().get_name()),
+                                    generate_mqtt_compatible_name(device.get_device_name()),
+                                    generate_mqtt_compatible_name(point))
+
+def get_device_state_topic(mqtt_base_topic, device):
+    return "{}/state/{}/{}".format(mqtt_base_topic, generate_mqtt_compatible_name(device.get_sc().get_name()),
+                                   generate_mqtt_compatible_name(device.get_device_name()))
+
+def get_device_state_payload(points):
+    state = {}
+    for point in points:
+        state[generate_mqtt_compatible_name(point.get_point_name())] = {"value": point.get_point_value(),
+                                                                        "type": point.get_point_type(),
+                                                                        "ts": point.get_point_last_updated()}
+    return json.dumps(state)
+
+def get_point_state_discovery(mqtt_base_topic, device, point, json_state=False, binary=False):
+    if not json_state:
+        return {"stat_t": get_point_state_topic(mqtt_base_topic, device, point)}
+
+    #a point that has no value yet is absent from the device document, so keep the current state until it has one
+    #(binary sensors ignore an empty template result)
+    key = generate_mqtt_compatible_name(point)
+    if binary:
+        fallback = "''"
+    else:
+        fallback = "this.state"
+    template = "{{ value_json['" + key + "'].value if '" + key + "' in value_json else " + fallback + " }}"
+
+    return {"stat_t": get_device_state_topic(mqtt_base_topic, device), "val_tpl": template}
+
 def get_trane_climate_sets(device):
     points = device.get_points_list()
     if ("CoolingCapacityStatus" in points and "HeatingCapacityPrimary" in points and "SpaceTempActive" in points) or \
@@ -190,79 +222,117 @@ class TraneClimateSet(object):
     def get_device(self):
         return self.device
 
-    def get_cool_capacity(self):
-        if self.coolCapacity == "%%DYNAMIC%%" and self.get_temp_active() > self.get_temp_setpoint():
-            return 100.0
-        elif self.coolCapacity == "%%DYNAMIC%%":
-            return 0.0
-
-        return self.device.get_point(self.coolCapacity).get_point_valid_value()
+    def read_point(self, point_name):
+        return self.device.get_point(point_name).get_point_valid_value()
+
+    def is_stale(self):
+        #true while every backing point only holds a value seeded from the broker, not one polled from the SC
+        for point_name in (self.climateSetMode, self.coolCapacity, self.heatCapacity, self.tempActive, self.tempSetpoint,
+                           self.fanSpeed):
+            point = self.device.get_point(point_name) if point_name is not None else None
+            if point is not None and not point.is_point_stale():
+                return False
+        return True
+
+    def select_setpoint(self, mode, heat_setpoint, cool_setpoint, temp_active):
+        if mode == "heat":
+            return heat_setpoint
+        elif mode == "cool":
+            return cool_setpoint
+        else:
+            return temp_active
 
-    def get_heat_capacity(self):
-        if self.heatCapacity == "%%DYNAMIC%%" and self.get_temp_active() < self.get_temp_setpoint():
-            return 100.0
-        elif self.heatCapacity == "%%DYNAMIC%%":
-            return 0.0
+    def evaluate(self):
+        #reads every backing point once and resolves the whole climate state in a single pass
+        temp_active = self.read_point(self.tempActive)
 
-        return self.device.get_point(self.heatCapacity).get_point_valid_value()
+        if self.tempSetpoint == "%%DYNAMIC%%":
+            setpoint = None
+            if self.read_point("OccupancyStatus"):
+                heat_setpoint = self.read_point("SpaceTempOccHeatSptBAS")
+                cool_setpoint = self.read_point("SpaceTempOccCoolSptBAS")
+            else:
+                heat_setpoint = self.read_point("SpaceTempUnoccHeatSpt")
+                cool_setpoint = self.read_point("SpaceTempUnoccCoolSpt")
+        else:
+            setpoint = self.read_point(self.tempSetpoint)
+            heat_setpoint = setpoint
+            cool_setpoint = setpoint
 
-    def get_climate_set_mode(self):
+        mode = None
         if self.climateSetMode is not None:
-            point_value = self.device.get_point(self.climateSetMode).get_point_valid_value()
-            if "heat" in point_value.lower():
-                return "heat"
-            else:
-                return point_value
+            mode = self.read_point(self.climateSetMode)
+            if "heat" in mode.lower():
+                mode = "heat"
+
+        if setpoint is None and mode is not None:
+            setpoint = self.select_setpoint(mode, heat_setpoint, cool_setpoint, temp_active)
+            heat_setpoint = setpoint
+            cool_setpoint = setpoint
+
+        #without a known mode, dynamic capacities compare against the occupancy heat/cool setpoints directly
+        if self.coolCapacity == "%%DYNAMIC%%":
+            cool_capacity = 100.0 if temp_active > cool_setpoint else 0.0
+        else:
+            cool_capacity = self.read_point(self.coolCapacity)
+
+        if self.heatCapacity == "%%DYNAMIC%%":
+            heat_capacity = 100.0 if temp_active < heat_setpoint else 0.0
         else:
-            if self.get_cool_capacity() > 0:
-                return "cool"
-            elif self.get_heat_capacity() > 0:
-                return "heat"
+            heat_capacity = self.read_point(self.heatCapacity)
+
+        if cool_capacity > 0:
+            run_mode = "cooling"
+        elif heat_capacity > 0:
+            run_mode = "heating"
+        else:
+            run_mode = "idle"
+
+        if mode is None:
+            if cool_capacity > 0:
+                mode = "cool"
+            elif heat_capacity > 0:
+                mode = "heat"
             else:
-                return "off"
+                mode = "off"
+
+        if setpoint is None:
+            setpoint = self.select_setpoint(mode, heat_setpoint, cool_setpoint, temp_active)
+
+        if self.fanSpeed is None:
+            fan_speed = 100.0 if run_mode != "idle" else 0.0
+        else:
+            fan_speed = self.read_point(self.fanSpeed)
+
+        return {"action": run_mode, "temp": temp_active, "fan": "on" if fan_speed > 0 else "off", "mode": mode,
+                "set": setpoint, "cool_capacity": cool_capacity, "heat_capacity": heat_capacity, "fan_speed": fan_speed}
+
+    def get_state_payload(self, state=None):
+        if state is None:
+            state = self.evaluate()
+        return json.dumps({"action": state["action"], "temp": state["temp"], "fan": state["fan"],
+                           "mode": state["mode"], "set": state["set"]})
+
+    def get_cool_capacity(self):
+        return self.evaluate()["cool_capacity"]
+
+    def get_heat_capacity(self):
+        return self.evaluate()["heat_capacity"]
+
+    def get_climate_set_mode(self):
+        return self.evaluate()["mode"]
 
     def get_temp_active(self):
-        return self.device.get_point(self.tempActive).get_point_valid_value()
+        return self.read_point(self.tempActive)
 
     def get_temp_setpoint(self):
-        if self.tempSetpoint == "%%DYNAMIC%%":
-            occupied = self.device.get_point("OccupancyStatus").get_point_valid_value()
-            if occupied:
-                if self.get_climate_set_mode() == "heat":
-                    return self.device.get_point("SpaceTempOccHeatSptBAS").get_point_valid_value()
-                elif self.get_climate_set_mode() == "cool":
-                    return self.device.get_point("SpaceTempOccCoolSptBAS").get_point_valid_value()
-                else:
-                    return self.get_temp_active()
-            else:
-                if self.get_climate_set_mode() == "heat":
-                    return self.device.get_point("SpaceTempUnoccHeatSpt").get_point_valid_value()
-                elif self.get_climate_set_mode() == "cool":
-                    return self.device.get_point("SpaceTempUnoccCoolSpt").get_point_valid_value()
-                else:
-                    return self.get_temp_active()
-        else:
-            return self.device.get_point(self.tempSetpoint).get_point_valid_value()
+        return self.evaluate()["set"]
 
     def get_climate_run_mode(self):
-        if self.get_cool_capacity() > 0:
-            return "cooling"
-        elif self.get_heat_capacity() > 0:
-            return "heating"
-        else:
-            return "idle"
+        return self.evaluate()["action"]
 
     def get_fan_speed(self):
-        if self.fanSpeed is None:
-            if self.get_climate_run_mode() != "idle":
-                return 100.0
-            else:
-                return 0.0
-
-        return self.device.get_point(self.fanSpeed).get_point_valid_value()
+        return self.evaluate()["fan_speed"]
 
     def get_fan_state(self):
-        if self.get_fan_speed() > 0:
-            return "on"
-        else:
-            return "off"
\ No newline at end of file
+        return self.evaluate()["fan"]
@@ -0,0 +1,197 @@
+#!python3
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+import paho.mqtt.client as MqttClient
+
+# what to do with a new message when the queue is full
+queue_policies = ["block", "drop_oldest", "drop_new"]
+# messages on these topics are never dropped, a full queue waits for room instead
+protected_prefixes = ["homeassistant/"]
+
+
+class MqttPublisher(object):
+    def __init__(self, send, max_queue=1000, policy="block", max_inflight=20, inflight_timeout=60, on_lost=None):
+        if policy not in queue_policies:
+            raise ValueError("Queue policy must be one of {}.".format(", ".join(queue_policies)))
+        if max_queue < 1:
+            raise ValueError("Queue size must be at least 1.")
+        if max_inflight < 1:
+            raise ValueError("Maximum inflight messages must be at least 1.")
+
+        self.send = send
+        #called with the topic of every message that was dropped or failed to publish
+        self.on_lost = on_lost
+        self.max_queue = max_queue
+        self.policy = policy
+        self.max_inflight = max_inflight
+        self.inflight_timeout = inflight_timeout
+        #pending messages by topic, a newer value for a queued topic replaces the older one
+        self.queue = OrderedDict()
+        self.inflight = {}
+        self.completed_early = set()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        self.published = 0
+        self.dropped = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_count = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        #give queued messages a chance to go out before stopping
+        end_time = time.time() + timeout
+        with self.condition:
+            while (len(self.queue) > 0 or len(self.inflight) > 0) and time.time() < end_time:
+                self.condition.wait(end_time - time.time())
+            self.running = False
+            self.condition.notify_all()
+
+    def is_protected(self, topic):
+        for prefix in protected_prefixes:
+            if topic.startswith(prefix):
+                return True
+        return False
+
+    def find_droppable(self):
+        for topic in self.queue.keys():
+            if not self.is_protected(topic):
+                return topic
+        return None
+
+    def report_lost(self, topics):
+        if self.on_lost is None:
+            return
+        for topic in topics:
+            try:
+                self.on_lost(topic)
+            except Exception as lost_error:
+                logging.log(logging.WARNING, "Failed to handle the lost message on {}: {}".format(topic, lost_error))
+
+    def publish(self, topic, payload=None, qos=0, retain=False, alias=False):
+        lost = []
+        with self.condition:
+            if topic in self.queue:
+                self.queue[topic] = (payload, qos, retain, alias, self.queue[topic][4])
+                self.coalesced = self.coalesced + 1
+                return True
+
+            accepted = True
+            while len(self.queue) >= self.max_queue:
+                droppable = self.find_droppable()
+                if self.policy == "drop_new" and not self.is_protected(topic):
+                    self.dropped = self.dropped + 1
+                    lost.append(topic)
+                    accepted = False
+                    break
+                elif self.policy == "drop_oldest" and droppable is not None:
+                    del self.queue[droppable]
+                    self.dropped = self.dropped + 1
+                    lost.append(droppable)
+                else:
+                    self.condition.wait()
+
+            if accepted:
+                self.queue[topic] = (payload, qos, retain, alias, time.time())
+                self.condition.notify_all()
+
+        self.report_lost(lost)
+        return accepted
+
+    def on_published(self, mid):
+        with self.condition:
+            if mid in self.inflight:
+                self.complete(mid)
+            else:
+                #paho can report a publish before the send call has returned its mid
+                self.completed_early.add(mid)
+
+    def complete(self, mid):
+        latency = time.time() - self.inflight.pop(mid)[0]
+        self.published = self.published + 1
+        self.latency_total = self.latency_total + latency
+        self.latency_count = self.latency_count + 1
+        self.latency_max = max(self.latency_max, latency)
+        self.condition.notify_all()
+
+    def expire_inflight(self):
+        #messages lost with a dropped connection are never acknowledged, so stop waiting on them
+        expired = []
+        expired_time = time.time() - self.inflight_timeout
+        for mid, message in list(self.inflight.items()):
+            if message[0] < expired_time:
+                del self.inflight[mid]
+                self.failed = self.failed + 1
+                expired.append(message[1])
+        return expired
+
+    def run(self):
+        while True:
+            lost = []
+            with self.condition:
+                while self.running and len(lost) == 0 and (len(self.queue) == 0 or len(self.inflight) >= self.max_inflight):
+                    self.condition.wait(1)
+                    lost = self.expire_inflight()
+                if not self.running:
+                    return
+
+            #expired messages are reported without holding the lock, then the queue is checked again
+            if len(lost) > 0:
+                self.report_lost(lost)
+                continue
+
+            with self.condition:
+                topic, message = self.queue.popitem(last=False)
+                payload, qos, retain, alias, enqueued = message
+                self.condition.notify_all()
+
+            try:
+                info = self.send(topic, payload, qos, retain, alias)
+            except Exception as publish_error:
+                logging.log(logging.WARNING, "Failed to publish to {}: {}".format(topic, publish_error))
+                with self.condition:
+                    self.failed = self.failed + 1
+                self.report_lost([topic])
+                continue
+
+            if info.rc != MqttClient.MQTT_ERR_SUCCESS:
+                logging.log(logging.WARNING, "Failed to publish to {} ({}).".format(topic, MqttClient.error_string(info.rc)))
+                with self.condition:
+                    self.failed = self.failed + 1
+                self.report_lost([topic])
+                continue
+
+            with self.condition:
+                self.inflight[info.mid] = (enqueued, topic)
+                if info.mid in self.completed_early:
+                    self.completed_early.discard(info.mid)
+                    self.complete(info.mid)
+
+    def get_stats(self):
+        #returns the counters since the previous call
+        with self.condition:
+            stats = {"queue_depth": len(self.queue), "inflight": len(self.inflight), "published": self.published,
+                     "dropped": self.dropped, "failed": self.failed, "coalesced": self.coalesced,
+                     "latency_avg": round(self.latency_total / self.latency_count, 4) if self.latency_count > 0 else 0.0,
+                     "latency_max": round(self.latency_max, 4)}
+
+            self.published = 0
+            self.dropped = 0
+            self.failed = 0
+            self.coalesced = 0
+            self.latency_total = 0.0
+            self.latency_max = 0.0
+            self.latency_count = 0
+
+        return stats
@@ -0,0 +1,168 @@
+#!python3
+
+import os
+import time
+import logging
+import threading
+import pstats
+import cProfile
+import tracemalloc
+
+# timing spans are only recorded while enabled, otherwise span() hands back a shared no-op
+spans_enabled = False
+span_stats = {}
+span_lock = threading.Lock()
+# the running Profiler, worker threads record into it through profiled()
+active_profiler = None
+
+
+class Span(object):
+    __slots__ = ("key", "start")
+
+    def __init__(self, key):
+        self.key = key
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        with span_lock:
+            stats = span_stats.get(self.key)
+            if stats is None:
+                span_stats[self.key] = [1, elapsed, elapsed]
+            else:
+                stats[0] = stats[0] + 1
+                stats[1] = stats[1] + elapsed
+                stats[2] = max(stats[2], elapsed)
+        return False
+
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+null_span = NullSpan()
+
+
+def span(stage, sc=None, device=None):
+    if not spans_enabled:
+        return null_span
+    return Span((stage, sc, device))
+
+
+def set_spans_enabled(enabled):
+    global spans_enabled
+
+    spans_enabled = enabled
+    logging.log(logging.INFO, "Timing spans are now {}.".format("enabled" if enabled else "disabled"))
+
+
+def get_span_stats():
+    #returns (stage, sc, device, count, total, max) rows since the previous call, slowest stages first
+    global span_stats
+
+    with span_lock:
+        stats = span_stats
+        span_stats = {}
+
+    rows = []
+    for key, values in stats.items():
+        rows.append((key[0], key[1], key[2], values[0], values[1], values[2]))
+    rows.sort(key=lambda row: row[4], reverse=True)
+    return rows
+
+
+def profiled(function, *args):
+    #cProfile only follows the thread that enabled it, so work handed to other threads profiles itself
+    profiler = active_profiler
+    if profiler is None:
+        return function(*args)
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        #newer Pythons profile every thread from the one profiler, and refuse a second one
+        return function(*args)
+    try:
+        return function(*args)
+    finally:
+        profile.disable()
+        profiler.add_thread_profile(profile)
+
+
+def log_span_stats(limit=20):
+    for stage, sc, device, count, total, maximum in get_span_stats()[:limit]:
+        logging.log(logging.INFO, "Span {} on {}/{}: {} calls, {:.3f}s total, {:.3f}s max.".format(stage, sc, device, count,
+                                                                                                  total, maximum))
+
+
+class Profiler(object):
+    def __init__(self, output_dir="."):
+        self.output_dir = output_dir
+        self.profile = None
+        self.thread_profiles = []
+        self.lock = threading.Lock()
+
+    def is_running(self):
+        return self.profile is not None
+
+    def add_thread_profile(self, profile):
+        with self.lock:
+            self.thread_profiles.append(profile)
+
+    def start(self):
+        #cProfile only follows the thread that starts it, so this needs to run on the polling thread
+        global active_profiler
+
+        if self.profile is not None:
+            return
+
+        logging.log(logging.INFO, "Starting the profiler.")
+        tracemalloc.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        active_profiler = self
+
+    def stop(self):
+        if self.profile is None:
+            return None
+
+        global active_profiler
+
+        active_profiler = None
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        #worker threads still finishing a call may add their profile late, those are left out
+        with self.lock:
+            thread_profiles = self.thread_profiles
+            self.thread_profiles = []
+        stats = pstats.Stats(self.profile)
+        for profile in thread_profiles:
+            stats.add(profile)
+
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        profile_file = os.path.join(self.output_dir, "profile_{}.pstats".format(timestamp))
+        memory_file = os.path.join(self.output_dir, "memory_{}.txt".format(timestamp))
+
+        try:
+            stats.dump_stats(profile_file)
+            with open(memory_file, "w") as stream:
+                for statistic in snapshot.statistics("lineno")[:50]:
+                    stream.write("{}\n".format(statistic))
+            logging.log(logging.INFO, "Profiler stopped, wrote {} and {}.".format(profile_file, memory_file))
+        except OSError as write_error:
+            logging.log(logging.WARNING, "Profiler stopped, but the results could not be written: {}".format(write_error))
+            profile_file = None
+
+        self.profile = None
+        return profile_file
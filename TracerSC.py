@@ -6,8 +6,15 @@ import xml.etree.ElementTree as ET
 import logging
 from requests.auth import HTTPDigestAuth
 import hashlib
-
-# points containing the text in valid_points will be included
+import threading
+import queue
+import re
+import math
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from TracerProfiling import span, profiled
+
+# points with an exact (case sensitive) name match in valid_points are included by default
 #valid_points = ["communication", "humidity", "temp", "air", "pressure", "speed", "startstop", "capacity", "heatcoolmodestatus", "occupancy", "fan", "command"]
 valid_points = [
 "CommunicationStatus",
@@ -57,42 +64,268 @@ valid_points = [
 invalid_points = ["LowTemperatureAlarm", "DiagOutdoorAirTempSourceFailure", "DiagSpaceTempSourceFailure", "SupplyFanFailureReset", "SupplyFanFailure"]
 
 
-def is_valid_point_name(point):
-    for invalid_point in invalid_points:
-        if invalid_point == point:
-            return False
-    for valid_point in valid_points:
-        if valid_point in point.lower() or valid_point == point:
-            return True
-    return False
+# device metadata attributes, mapped to the TraneDevice field they populate
+metadata_attributes = {"ModelName": "model", "VendorName": "make", "FirmwareRevision": "version"}
+# seconds to wait before asking again for metadata that could not be read
+metadata_retry_interval = 600
+
+
+# pre-type conversion rules, raw values listed in values are mapped and anything else becomes the default
+# (additional rules can be loaded from the bridge configuration with set_conversion_rules)
+conversion_rules = {
+    "OccupancyRequest": {"values": {"1": "true"}, "default": "false"},
+    "OccupancyStatus": {"values": {"1": "true"}, "default": "false"},
+    "CommunicationStatus": {"values": {"3": "true"}, "default": "false"},
+    "HeatCoolModeStatus": {"values": {"1": "Auto", "2": "Heat", "3": "Heat", "13": "Heat", "9": "Emergency Heat",
+                                      "4": "Cool", "6": "Cool", "11": "Cool"}, "default": "Off"}
+}
+default_conversion_rules = dict(conversion_rules)
+compiled_conversions = {}
+
+
+def build_conversion_rules(rules):
+    #validates the configured rules and merges them over the defaults, without applying them
+    if not isinstance(rules, dict):
+        raise ValueError("Conversion rules must be a mapping of point names to rules.")
+
+    merged = dict(default_conversion_rules)
+    for point_name, rule in rules.items():
+        if not isinstance(rule, dict) or not isinstance(rule.get("values"), dict):
+            raise ValueError("Conversion rule for {} is missing the values mapping.".format(point_name))
+        merged[str(point_name)] = rule
+    return merged
+
+
+def set_conversion_rules(rules):
+    #rebuilt from the defaults every time, so rules removed from the configuration stop applying
+    merged = build_conversion_rules(rules)
+    conversion_rules.clear()
+    conversion_rules.update(merged)
+    compiled_conversions.clear()
+
+
+def convert_value_type(value, type):
+    lowered = value.lower()
+    if lowered == "true":
+        return "True", "bool"
+    elif lowered == "false":
+        return "False", "bool"
+    elif "e+" in lowered or "e-" in lowered:
+        return str(float(value)), "float"
+    else:
+        return value, type
+
+
+def compile_conversion(point_name):
+    if point_name not in compiled_conversions:
+        rule = conversion_rules.get(point_name)
+        if rule is None:
+            compiled_conversions[point_name] = None
+        else:
+            #resolve the final value and type of every mapping up front, so an update is a single lookup
+            table = {}
+            for raw_value, converted_value in rule["values"].items():
+                table[str(raw_value)] = convert_value_type(str(converted_value), "string")
+            default = None
+            if "default" in rule.keys():
+                default = convert_value_type(str(rule["default"]), "string")
+            compiled_conversions[point_name] = (table, default)
+
+    return compiled_conversions[point_name]
+
+
+def compile_point_rules(rules):
+    #rules are grouped by device family (None applies to every family) into an exact name set and one combined regex
+    exact = {}
+    patterns = {}
+    for rule in rules:
+        if isinstance(rule, str):
+            rule = {"exact": rule}
+        elif not isinstance(rule, dict):
+            raise ValueError("Point rule {} must be a point name or a mapping.".format(rule))
+
+        families = rule.get("families")
+        if families is None:
+            families = [None]
+        else:
+            #a single family may be given without a list
+            if isinstance(families, str):
+                families = [families]
+            elif not isinstance(families, list):
+                raise ValueError("Point rule {} needs families to be a family name or a list of them.".format(rule))
+            families = [str(family).lower() for family in families]
+
+        for family in families:
+            if "exact" in rule.keys():
+                exact.setdefault(family, set()).add(str(rule["exact"]))
+            elif "prefix" in rule.keys():
+                patterns.setdefault(family, []).append(re.escape(str(rule["prefix"])) + ".*")
+            elif "regex" in rule.keys():
+                re.compile(str(rule["regex"]))
+                patterns.setdefault(family, []).append(str(rule["regex"]))
+            else:
+                raise ValueError("Point rule {} needs an exact, prefix or regex key.".format(rule))
+
+    compiled = {}
+    for family in set(exact.keys()) | set(patterns.keys()):
+        pattern = None
+        if family in patterns:
+            pattern = re.compile("|".join("(?:{})".format(item) for item in patterns[family]))
+        compiled[family] = (exact.get(family, set()), pattern)
+    return compiled
+
+
+class PointSelector(object):
+    def __init__(self, include, exclude):
+        self.include = compile_point_rules(include)
+        self.exclude = compile_point_rules(exclude)
+        self.cache = {}
+
+    def matches(self, rules, point, family):
+        for key in (None, family):
+            if key in rules:
+                exact, pattern = rules[key]
+                if point in exact or (pattern is not None and pattern.fullmatch(point) is not None):
+                    return True
+        return False
+
+    def is_selected(self, point, family=None):
+        if family is not None:
+            family = family.lower()
+
+        key = (family, point)
+        if key not in self.cache:
+            self.cache[key] = not self.matches(self.exclude, point, family) and self.matches(self.include, point, family)
+        return self.cache[key]
+
+
+point_selector = PointSelector(valid_points, invalid_points)
+
+
+def create_point_selector(config):
+    if not isinstance(config, dict):
+        raise ValueError("Point selection must be a mapping with include and exclude lists.")
+
+    include = config.get("include", [])
+    exclude = config.get("exclude", [])
+    if not isinstance(include, list) or not isinstance(exclude, list):
+        raise ValueError("Point selection include and exclude must be lists of rules.")
+    if not config.get("replace_defaults", False):
+        include = valid_points + include
+        exclude = invalid_points + exclude
+
+    return PointSelector(include, exclude)
+
+
+def set_point_selector(selector):
+    global point_selector
+
+    point_selector = selector
+
+
+def set_point_selection(config):
+    set_point_selector(create_point_selector(config))
+
+
+def is_valid_point_name(point, family=None):
+    return point_selector.is_selected(point, family)
+
 
+class TracerRequestError(Exception):
+    #overload marks failures that say the SC is struggling (no answer, timeouts, 5xx) rather than an unreadable resource
+    def __init__(self, message, overload=False):
+        super(TracerRequestError, self).__init__(message)
+        self.overload = overload
+
+
+def request_xml(url, username=None, password=None, session=None, auth=None, sc_name=None, device_name=None, timeout=None):
+    if auth is None and username is not None and password is not None:
+        auth = HTTPDigestAuth(username, password)
+    if session is None:
+        session = requests
 
-def make_xml_get_request(url, username=None, password=None):
     try:
-        if username is not None and password is not None:
-            auth = HTTPDigestAuth(username, password)
-            request = requests.get(url, verify=False, auth=auth)
-        else:
-            request = requests.get(url, verify=False)
+        with span("http", sc_name, device_name):
+            if auth is not None:
+                request = session.get(url, verify=False, auth=auth, timeout=timeout)
+            else:
+                request = session.get(url, verify=False, timeout=timeout)
+    except requests.exceptions.Timeout:
+        raise TracerRequestError("Request to {} timed out after {}s!".format(url, timeout), True)
     except:
-        logging.log(logging.WARNING, "Failed to execute a request to {}!".format(url))
-        request = None
+        raise TracerRequestError("Failed to execute a request to {}!".format(url), True)
 
-    if request is None or request.status_code != 200:
+    if request.status_code != 200:
         if request.status_code == 401 or request.status_code == 403:
-            logging.log(logging.WARNING, "Request to {} returned unauthorized!".format(url))
-        else:
-            logging.log(logging.WARNING, "Request to {} did not return success!".format(url))
-        return None
+            raise TracerRequestError("Request to {} returned unauthorized!".format(url))
+        raise TracerRequestError("Request to {} did not return success!".format(url), request.status_code >= 500)
 
     try:
-        request_tree = ET.ElementTree(ET.fromstring(request.content))
+        with span("parse", sc_name, device_name):
+            request_tree = ET.ElementTree(ET.fromstring(request.content))
         return request_tree
     except:
-        logging.log(logging.WARNING, "Response from {} did not return valid XML!".format(url))
+        raise TracerRequestError("Response from {} did not return valid XML!".format(url))
+
+
+def make_xml_get_request(url, username=None, password=None, session=None, auth=None, sc_name=None, device_name=None, timeout=None):
+    try:
+        return request_xml(url, username, password, session, auth, sc_name, device_name, timeout)
+    except TracerRequestError as request_error:
+        logging.log(logging.WARNING, str(request_error))
         return None
 
 
+class AdaptiveConcurrency(object):
+    #AIMD limit on parallel requests to one SC: grow by one while the p95 latency of a window stays on target,
+    #halve when it does not or when requests fail
+    def __init__(self, minimum=1, maximum=4, target_latency=0.5, window=20):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.target_latency = target_latency
+        self.window = window
+        self.limit = float(self.minimum)
+        self.inflight = 0
+        self.samples = []
+        self.errors = 0
+        self.last_p95 = 0.0
+        self.condition = threading.Condition()
+
+    def get_limit(self):
+        return int(self.limit)
+
+    def get_last_p95(self):
+        return self.last_p95
+
+    def acquire(self):
+        with self.condition:
+            while self.inflight >= int(self.limit):
+                self.condition.wait()
+            self.inflight = self.inflight + 1
+
+    def release(self, latency, success=True):
+        with self.condition:
+            self.inflight = self.inflight - 1
+            self.samples.append(latency)
+            if not success:
+                self.errors = self.errors + 1
+            if len(self.samples) >= self.window:
+                self.adjust()
+            self.condition.notify_all()
+
+    def adjust(self):
+        samples = sorted(self.samples)
+        self.last_p95 = samples[int(math.ceil(0.95 * len(samples))) - 1]
+
+        if self.errors == 0 and self.last_p95 <= self.target_latency:
+            self.limit = min(self.maximum, self.limit + 1)
+        else:
+            self.limit = max(self.minimum, self.limit / 2)
+
+        self.samples = []
+        self.errors = 0
+
+
 class TracerSC(object):
     def __init__(self, name, hostname, username=None, password=None):
         self.name = name
@@ -108,6 +341,24 @@ class TracerSC(object):
         self.password = password
         self.fixed_discovery = []
 
+        #one session and digest auth per SC, so the nonce and nc counter are reused between requests
+        self.session = requests.Session()
+        self.session.verify = False
+        if username is not None and password is not None:
+            self.auth = HTTPDigestAuth(username, password)
+        else:
+            self.auth = None
+
+        self.request_timeout = 10
+
+        self.metadata_queue = queue.Queue()
+        self.metadata_thread = None
+        self.metadata_listener = None
+
+        self.concurrency = None
+        self.poll_executor = None
+        self.set_concurrency()
+
     def does_device_exist(self, url):
         return not (self.get_device_by_url(url) is None)
 
@@ -144,11 +395,80 @@ class TracerSC(object):
     def get_password(self):
         return self.password
 
+    def set_concurrency(self, minimum=1, maximum=4, target_latency=0.5):
+        self.concurrency = AdaptiveConcurrency(minimum, maximum, target_latency)
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=self.concurrency.maximum))
+        if self.poll_executor is not None:
+            self.poll_executor.shutdown(wait=False)
+        self.poll_executor = ThreadPoolExecutor(max_workers=self.concurrency.maximum)
+
+    def get_concurrency(self):
+        return self.concurrency
+
+    def set_request_timeout(self, timeout):
+        self.request_timeout = timeout
+
     def set_fixed_discovery(self, names):
         self.fixed_discovery = names
 
+    def get_fixed_discovery(self):
+        return self.fixed_discovery
+
+    def rediscover_points(self):
+        #applies changed point selection rules to the devices we already know about
+        for device in self.devices:
+            device.discover_device()
+
+    def shutdown(self):
+        #stops the polling pool and the metadata worker of an SC that is no longer bridged
+        self.poll_executor.shutdown(wait=False)
+        if self.metadata_thread is not None:
+            self.metadata_queue.put(None)
+
+    def refilter_devices(self):
+        #drops devices no longer matched by the fixed discovery list, newly listed devices need discovery afterwards
+        if len(self.fixed_discovery) > 0:
+            self.devices = [device for device in self.devices if device.get_device_name() in self.fixed_discovery]
+
+    def set_metadata_listener(self, listener):
+        self.metadata_listener = listener
+
+    def request_device_metadata(self, device):
+        #device metadata is only needed for discovery payloads, so fetch it off the polling path
+        self.metadata_queue.put(device)
+        if self.metadata_thread is None:
+            self.metadata_thread = threading.Thread(target=self.fetch_device_metadata, daemon=True)
+            self.metadata_thread.start()
+
+    def fetch_device_metadata(self):
+        while True:
+            device = self.metadata_queue.get()
+            if device is None:
+                return
+            if not profiled(device.fetch_metadata):
+                logging.log(logging.DEBUG, "No metadata could be read for device {}, retrying later.".format(device.get_device_name()))
+                continue
+            if self.metadata_listener is not None:
+                try:
+                    self.metadata_listener(device)
+                except:
+                    logging.log(logging.WARNING, "Failed to handle metadata for device {} on {}!".format(device.get_device_name(), self.name))
+
+    def make_anonymous_request(self, url, device_name=None):
+        return make_xml_get_request(url, session=self.session, sc_name=self.name, device_name=device_name,
+                                    timeout=self.request_timeout)
+
+    def make_authenticated_request(self, url, device_name=None):
+        #without credentials configured, authenticated endpoints are attempted anonymously
+        return make_xml_get_request(url, session=self.session, auth=self.auth, sc_name=self.name, device_name=device_name,
+                                    timeout=self.request_timeout)
+
+    def request_anonymous(self, url, device_name=None):
+        #like make_anonymous_request, but raises a TracerRequestError that says what kind of failure it was
+        return request_xml(url, session=self.session, sc_name=self.name, device_name=device_name, timeout=self.request_timeout)
+
     def discover_sc(self):
-        about_tree = make_xml_get_request("https://{}/evox/about".format(self.hostname))
+        about_tree = self.make_anonymous_request("https://{}/evox/about".format(self.hostname))
 
         if about_tree is None:
             logging.log(logging.WARNING, "Failed to discover SC on {} ({}):  device was not reachable!".format(self.name, self.hostname))
@@ -158,7 +478,7 @@ class TracerSC(object):
         self.device_version = str(about_tree.find('./str[@name="productVersion"]').get("val"))
         self.device_serial = str(about_tree.find('./str[@name="hardwareSerialNumber"]').get("val"))
 
-        ethernet_tree = make_xml_get_request("https://{}/evox/config/enet/link/eth0".format(self.hostname), self.username, self.password)
+        ethernet_tree = self.make_authenticated_request("https://{}/evox/config/enet/link/eth0".format(self.hostname))
         if ethernet_tree is None:
             logging.log(logging.WARNING,
                         "Failed to read ethernet info on SC {} ({}):  unable to get response!".format(self.name, self.hostname))
@@ -167,6 +487,7 @@ class TracerSC(object):
         else:
             self.device_mac = str(ethernet_tree.find('./str[@name="macaddr"]').get("val"))
 
+        self.reachable = True
         return True
 
     def discover_devices(self):
@@ -174,7 +495,7 @@ class TracerSC(object):
 
         discovery_url = "https://{}/evox/equipment/installedSummary".format(self.hostname)
         logging.log(logging.DEBUG, "Now attempting discovery using url {}.".format(discovery_url))
-        installed_summary_tree = make_xml_get_request(discovery_url)
+        installed_summary_tree = self.make_anonymous_request(discovery_url)
 
         if installed_summary_tree is None:
             logging.log(logging.WARNING, "Failed to discover devices on {} ({}):  device was not reachable!".format(self.name, self.hostname))
@@ -202,6 +523,9 @@ class TracerSC(object):
                         #skip importing
                         continue
 
+                if self.does_device_exist("https://{}/{}".format(self.hostname, equipment_url)):
+                    continue
+
                 device_obj = TraneDevice(self, device_name, device_family, "https://{}/{}".format(self.hostname, equipment_url))
                 self.devices.append(device_obj)
                 device_obj.discover_device()
@@ -211,7 +535,7 @@ class TracerSC(object):
 
         discovery_url = "https://{}/evox/equipment/spaces".format(self.hostname)
         logging.log(logging.DEBUG, "Now attempting space discovery using url {}.".format(discovery_url))
-        installed_summary_tree = make_xml_get_request(discovery_url)
+        installed_summary_tree = self.make_anonymous_request(discovery_url)
 
         if installed_summary_tree is None:
             logging.log(logging.WARNING, "Failed to discover devices on {} ({}):  device was not reachable!".format(self.name, self.hostname))
@@ -224,8 +548,8 @@ class TracerSC(object):
             except:
                 equipment_url = None
 
-            if equipment_url is not None:
-                specific_equipment_request = make_xml_get_request(equipment_url)
+            if equipment_url is not None and not self.does_device_exist(equipment_url):
+                specific_equipment_request = self.make_anonymous_request(equipment_url)
                 device_name = str(specific_equipment_request.find('./str[@name="name"]').get("val"))
                 device_family = "Space"
 
@@ -242,9 +566,36 @@ class TracerSC(object):
             if (max is not None and count >= max):
                 break
 
+    def query_point(self, device, point):
+        self.concurrency.acquire()
+        start_time = time.time()
+        success = False
+        try:
+            logging.log(logging.DEBUG, "Querying value for point {} on device {}.".format(point.get_point_name(), device.get_device_name()))
+            profiled(point.query_point_value)
+            #an unreadable point is not a sign of load, only failures that point at the SC itself count against the limit
+            error = point.get_last_error()
+            success = error is None or not error.overload
+        finally:
+            self.concurrency.release(time.time() - start_time, success)
+
     def poll_devices(self):
+        #queries run in parallel, the adaptive limit decides how many are in flight against this SC
+        concurrency = self.concurrency
+        queries = {}
         for device in self.devices:
-            device.poll_device()
+            device.request_metadata()
+            for point in device.get_points():
+                queries[self.poll_executor.submit(self.query_point, device, point)] = (device, point)
+        wait(queries.keys())
+
+        for query, (device, point) in queries.items():
+            if query.exception() is not None:
+                logging.log(logging.WARNING, "Failed to poll point {} on device {}: {}".format(point.get_point_name(), device.get_device_name(),
+                                                                                             query.exception()))
+
+        logging.log(logging.DEBUG, "Concurrency limit on {} is now {} (p95 latency {:.3f}s).".format(self.name, concurrency.get_limit(),
+                                                                                                     concurrency.get_last_p95()))
 
 
 class TraneDevice(object):
@@ -257,6 +608,10 @@ class TraneDevice(object):
         self.make = "Trane"
         self.model = "Unknown Model"
         self.version = "1.0"
+        self.metadata_urls = {}
+        self.metadata_loaded = False
+        self.metadata_requested = False
+        self.metadata_retry_at = 0
 
     def __repr__(self):
         return "TraneDevice({})".format(self.name)
@@ -285,6 +640,33 @@ class TraneDevice(object):
     def get_version(self):
         return self.version
 
+    def get_metadata(self):
+        return {"make": self.make, "model": self.model, "version": self.version}
+
+    def set_metadata(self, metadata):
+        self.make = metadata.get("make", self.make)
+        self.model = metadata.get("model", self.model)
+        self.version = metadata.get("version", self.version)
+        self.metadata_loaded = True
+
+    def fetch_metadata(self):
+        #only counts as loaded once something was actually read, otherwise the device is asked for again later
+        read_any = False
+        for attribute_name, attribute_url in self.metadata_urls.items():
+            try:
+                metadata_tree = self.sc.make_authenticated_request(attribute_url, self.name)
+                setattr(self, metadata_attributes[attribute_name], metadata_tree.getroot().get("val"))
+                read_any = True
+            except:
+                logging.log(logging.DEBUG, "Unable to read {} on device {}.".format(attribute_name, self.name))
+
+        if read_any:
+            self.metadata_loaded = True
+        else:
+            self.metadata_retry_at = time.time() + metadata_retry_interval
+            self.metadata_requested = False
+        return read_any
+
     def get_id(self):
         return hashlib.md5(self.get_device_url().encode("utf-8")).hexdigest()
 
@@ -304,62 +686,55 @@ class TraneDevice(object):
         logging.log(logging.INFO, "Now attempting discovery on {} ({})".format(self.name, self.url))
 
         #discover points (or attributes in trane speak)
-        attributes_tree = make_xml_get_request("{}/attributes".format(self.url))
+        attributes_tree = self.sc.make_anonymous_request("{}/attributes".format(self.url), self.name)
         if attributes_tree is None:
             logging.log(logging.WARNING, "Unable to discover device {} ({}): unable to read the attributes list!".format(self.name, self.url))
             return
 
+        #points that are still selected keep their object (and value), so this can run again on a known device
+        points = []
         for attribute in attributes_tree.findall("obj"):
             attribute_name = str(attribute.find('./str[@name="key"]').get("val"))
             attribute_url = str(attribute.find('./ref[@name="attributeReference"]').get("href"))
 
-            if attribute_name == "ModelName":
-                try:
-                    model_tree = make_xml_get_request("https://{}{}".format(self.sc.get_hostname(), attribute_url), username=self.get_sc().get_username(), password=self.get_sc().get_password())
-                    self.model = model_tree.getroot().get("val")
-                except:
-                    pass
-
-            if attribute_name == "VendorName":
-                try:
-                    vendor_tree = make_xml_get_request("https://{}{}".format(self.sc.get_hostname(), attribute_url), username=self.get_sc().get_username(), password=self.get_sc().get_password())
-                    self.make = vendor_tree.getroot().get("val")
-                except:
-                    pass
-
-            if attribute_name == "FirmwareRevision":
-                try:
-                    vendor_tree = make_xml_get_request("https://{}{}".format(self.sc.get_hostname(), attribute_url), username=self.get_sc().get_username(), password=self.get_sc().get_password())
-                    self.version = vendor_tree.getroot().get("val")
-                except:
-                    pass
+            if attribute_name in metadata_attributes:
+                #metadata is fetched lazily once the device starts polling
+                self.metadata_urls[attribute_name] = "https://{}{}".format(self.sc.get_hostname(), attribute_url)
 
-            if not is_valid_point_name(attribute_name):
+            if not is_valid_point_name(attribute_name, self.family):
                 logging.log(logging.DEBUG, "Skipping ignored point name {}.".format(attribute_name))
                 continue
 
-            point = TranePoint(self.sc, attribute_name, "https://{}{}".format(self.sc.get_hostname(), attribute_url))
-            self.points.append(point)
+            point = self.get_point(attribute_name)
+            if point is None:
+                point = TranePoint(self.sc, attribute_name, "https://{}{}".format(self.sc.get_hostname(), attribute_url), self.name)
+            points.append(point)
+        self.points = points
 
         logging.log(logging.INFO, "Finished discovering device {} of type {}, and we found {} valid points.".format(self.name, self.family, len(self.points)))
 
-    def poll_device(self):
-        for point in self.points:
-            logging.log(logging.DEBUG, "Querying value for point {} on device {}.".format(point.get_point_name(), self.name))
-            point.query_point_value()
-
-        return self.points
+    def request_metadata(self):
+        if len(self.metadata_urls) == 0:
+            #nothing to fetch, the defaults are all there is
+            return
+        if not self.metadata_loaded and not self.metadata_requested and time.time() >= self.metadata_retry_at:
+            self.metadata_requested = True
+            self.sc.request_device_metadata(self)
 
 
 class TranePoint(object):
-    def __init__(self, sc, name, url):
+    def __init__(self, sc, name, url, device_name=None):
         self.sc = sc
         self.name = name
         self.url = url
+        self.device_name = device_name
         self.value = ""
         self.type = ""
         self.available = False
+        self.stale = False
         self.last_updated = 0
+        self.last_error = None
+        self.compile_conversion()
 
     def __repr__(self):
         return "TranePoint({}({})={})".format(self.name, self.type, self.value)
@@ -384,6 +759,27 @@ class TranePoint(object):
     def get_point_last_updated(self):
         return self.last_updated
 
+    def is_point_stale(self):
+        return self.stale
+
+    def get_last_error(self):
+        return self.last_error
+
+    def seed_value(self, value, type=None):
+        #seeds an already converted value (e.g. retained on the broker) until the point is polled again
+        if type is None:
+            value, type = convert_value_type(value, "string")
+            if type == "string" and "." in value:
+                try:
+                    float(value)
+                    type = "float"
+                except ValueError:
+                    pass
+
+        self.value = value
+        self.type = type
+        self.stale = True
+
     def get_point_valid_value(self):
         if self.type == "int":
             return int(self.get_point_value())
@@ -394,60 +790,42 @@ class TranePoint(object):
         else:
             return self.get_point_value()
 
-    def update_value(self, value, type):
-        #pre-type conversion rules
-        if self.name == "OccupancyRequest" or self.name == "OccupancyStatus":
-            if value == "1":
-                value = "true"
-            else:
-                value = "false"
-        if self.name == "CommunicationStatus":
-            if value == "3":
-                value = "true"
-            else:
-                value = "false"
-        if self.name == "HeatCoolModeStatus":
-            if value == "1":
-                value = "Auto"
-            elif value == "2" or value == "3" or value == "13":
-                value = "Heat"
-            elif value == "9":
-                value = "Emergency Heat"
-            elif value == "4" or value == "6" or value == "11":
-                value = "Cool"
-            else:
-                value = "Off"
-
-
-        #type conversion
-        if value.lower() == "true":
-            self.value = "True"
-            self.type = "bool"
-        elif value.lower() == "false":
-            self.value = "False"
-            self.type = "bool"
-        elif "e+" in value.lower() or "e-" in value.lower():
-            self.value = str(float(value))
-            self.type = "float"
+    def compile_conversion(self):
+        conversion = compile_conversion(self.name)
+        if conversion is None:
+            self.conversion_table = None
+            self.conversion_default = None
         else:
-            self.value = value
-            self.type = type
+            self.conversion_table, self.conversion_default = conversion
+
+    def update_value(self, value, type):
+        converted = None
+        if self.conversion_table is not None:
+            converted = self.conversion_table.get(value, self.conversion_default)
+
+        if converted is None:
+            converted = convert_value_type(value, type)
+        self.value, self.type = converted
 
+        self.stale = False
         self.available = True
         self.last_updated = time.time()
 
     def query_point_value(self):
-        xml_response = make_xml_get_request("{}/value".format(self.get_point_url()))
-
-        if xml_response is None:
+        self.last_error = None
+        try:
+            xml_response = self.sc.request_anonymous("{}/value".format(self.get_point_url()), self.device_name)
+        except TracerRequestError as request_error:
             self.available = False
+            self.last_error = request_error
             logging.log(logging.WARNING,
-                        "Unable to poll value of point {} ({}): unable to get response!".format(self.name, self.url))
+                        "Unable to poll value of point {} ({}): {}".format(self.name, self.url, request_error))
             return
 
         value = xml_response.getroot().get("val")
         if value is not None:
-            self.update_value(value, "string")
+            with span("convert", self.sc.get_name(), self.device_name):
+                self.update_value(value, "string")
             return self.get_point_value()
         else:
             self.available = False
\ No newline at end of file